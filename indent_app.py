@@ -1,5 +1,7 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import numpy as np
 import gspread
 from gspread import Client, Spreadsheet, Worksheet
 from fpdf import FPDF 
@@ -8,10 +10,14 @@ from datetime import datetime, date, timedelta
 import json
 from PIL import Image 
 from collections import Counter, defaultdict 
-from typing import Any, Dict, List, Tuple, Optional, DefaultDict, Union
+from typing import Any, Dict, Iterable, List, Tuple, Optional, DefaultDict, Set, Union
 import time
 from operator import itemgetter 
+from itertools import groupby, islice
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import urllib.parse 
+import requests 
 # from fuzzywuzzy import process as fuzzy_process # Removed for standard dropdown
 
 # --- Configuration & Setup ---
@@ -23,6 +29,31 @@ st.title("Material Indent Form")
 scope: List[str] = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 DEPARTMENTS = ["", "Kitchen", "Bar", "Housekeeping", "Admin", "Maintenance"] 
 TOP_N_SUGGESTIONS = 5 
+LOG_APPEND_CHUNK_SIZE = 250 
+LOG_APPEND_MAX_RETRIES = 3 
+MRN_TAIL_ROWS = 50 
+LOG_PAGE_SIZE = 500 
+LOG_REFRESH_SECONDS = 300 
+ITEM_FILTER_MIN_OPTIONS = 200 
+ITEM_FILTER_LIMIT = 50 
+LOG_COLUMNS = ['MRN', 'Timestamp', 'Requested By', 'Department', 'Date Required', 'Item', 'Qty', 'Unit', 'Note']
+# Column configs for the summary and log tables, built once rather than on every rerun
+SUMMARY_COLUMN_CONFIG = { 
+    "Category": st.column_config.TextColumn("Category"), 
+    "Sub-Category": st.column_config.TextColumn("Sub-Cat"),
+    "Qty": st.column_config.NumberColumn("Qty", format="%.3f") 
+}
+LOG_COLUMN_CONFIG = { 
+    "Date Required": st.column_config.DateColumn("Date Reqd.", format="DD/MM/YYYY"), 
+    "Timestamp": st.column_config.DatetimeColumn("Submitted", format="YYYY-MM-DD HH:mm"), 
+    "Requested By": st.column_config.TextColumn("Req. By"), 
+    "Qty": st.column_config.NumberColumn("Qty", format="%.3f"), 
+    "MRN": st.column_config.TextColumn("MRN"), 
+    "Department": st.column_config.TextColumn("Dept."), 
+    "Item": st.column_config.TextColumn("Item Name", width="medium"), 
+    "Unit": st.column_config.TextColumn("Unit"), 
+    "Note": st.column_config.TextColumn("Notes", width="large"), 
+}
 # FUZZY_SEARCH_LIMIT = 3 # Not needed anymore
 
 @st.cache_resource(show_spinner="Connecting to Google Sheets...")
@@ -46,6 +77,11 @@ def connect_gsheets():
             return None, None, None
         creds: ServiceAccountCredentials = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
         client: Client = gspread.authorize(creds)
+        # The client is cached, so its requests session (and pooled keep-alive connections) is shared by
+        # every rerun and user; keep requests' default pool sizes and retry dropped connections at the transport level
+        http_session = getattr(getattr(client, 'http_client', client), 'session', None)
+        if http_session is not None: 
+            http_session.mount('https://', requests.adapters.HTTPAdapter(max_retries=2))
         try:
             indent_log_spreadsheet: Spreadsheet = client.open("Indent Log")
             log_sheet: Worksheet = indent_log_spreadsheet.sheet1
@@ -76,78 +112,211 @@ if not client or not log_sheet or not reference_sheet:
     st.error("Failed Sheets connection.")
     st.stop()
 
+def get_sheet_values(sheet: Worksheet, cell_range: str) -> List[List[str]]:
+    """Reads one A1 range of a worksheet, asking the API for the cell values only (no range/dimension metadata)."""
+    response = sheet.spreadsheet.values_get(gspread.utils.absolute_range_name(sheet.title, cell_range), params={'fields': 'values'})
+    return response.get('values', [])
+
+def show_load_messages(messages: List[Tuple[str, str]]) -> None:
+    """Shows the (level, text) warnings/errors a cached loader returned; the loaders never write elements themselves."""
+    for level, message in messages: 
+        if level == 'error': st.error(message)
+        else: st.warning(message)
+
 # --- Reference Data Loading ---
-@st.cache_data(ttl=3600, show_spinner="Fetching item reference data...")
-def get_reference_data(_reference_sheet: Worksheet) -> Tuple[DefaultDict[str, List[str]], Dict[str, str], Dict[str, str], Dict[str, str]]:
-    item_to_unit_lower: Dict[str, str] = {}
-    item_to_category_lower: Dict[str, str] = {}
-    item_to_subcategory_lower: Dict[str, str] = {}
-    dept_to_items_map: DefaultDict[str, List[str]] = defaultdict(list)
+# The maps are only ever read, so every session shares the one cached copy instead of unpickling its own.
+# No spinner or st.* output in here: it may run in a worker thread, so its messages are returned for the caller to show.
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_reference_data(_reference_sheet: Worksheet) -> Tuple[DefaultDict[str, List[str]], Dict[str, str], Dict[str, str], Dict[str, str], List[Tuple[str, str]]]:
+    messages: List[Tuple[str, str]] = []
     try:
-        all_data: List[List[str]] = _reference_sheet.get_all_values()
+        # Only the five reference columns; the API trims trailing blanks, so rows are padded below
+        all_data: List[List[str]] = get_sheet_values(_reference_sheet, 'A:E')
         header_skipped: bool = False
         valid_departments = set(dept for dept in DEPARTMENTS if dept)
 
-        if all_data and ("item" in str(all_data[0][0]).lower() or "unit" in str(all_data[0][1]).lower()):
+        if all_data and all_data[0] and ("item" in str(all_data[0][0]).lower() or "unit" in str(all_data[0][1:2]).lower()):
             header_skipped = True
             data_rows = all_data[1:]
         else:
             data_rows = all_data
-
-        for i, row in enumerate(data_rows):
-            row_num_for_warning = i + (2 if header_skipped else 1)
-            if len(row) < 5: 
-                if any(str(cell).strip() for cell in row):
-                     st.warning(f"Skipping row {row_num_for_warning} in 'reference' sheet: expected 5 columns, found {len(row)}.")
-                continue
-            if not any(str(cell).strip() for cell in row[:5]): continue
-            
-            item: str = str(row[0]).strip()
-            unit: str = str(row[1]).strip()
-            permitted_depts_str: str = str(row[2]).strip()
-            category: str = str(row[3]).strip()
-            subcategory: str = str(row[4]).strip()
-            item_lower: str = item.lower()
-
-            if item:
-                item_to_unit_lower[item_lower] = unit if unit else "N/A"
-                item_to_category_lower[item_lower] = category if category else "Uncategorized"
-                item_to_subcategory_lower[item_lower] = subcategory if subcategory else "General"
-                
-                if not permitted_depts_str or permitted_depts_str.lower() == 'all':
-                    for dept_name in valid_departments:
-                        dept_to_items_map[dept_name].append(item)
-                else:
-                    departments_for_item = [dept.strip() for dept in permitted_depts_str.split(',') if dept.strip() in valid_departments]
-                    for dept_name in departments_for_item:
-                        dept_to_items_map[dept_name].append(item)
-            else:
-                if any(str(cell).strip() for cell in row[1:5]):
-                    st.warning(f"Skipping row {row_num_for_warning} in 'reference' sheet: Item name is missing.")
-
-        for dept_name in dept_to_items_map:
-            dept_to_items_map[dept_name] = sorted(list(set(dept_to_items_map[dept_name])))
+        first_row_num = 2 if header_skipped else 1
+
+        # Column-wise parsing; rows trimmed by the API are padded out to the five columns here
+        ref_cols = ['item', 'unit', 'depts', 'category', 'subcategory']
+        ref_df = pd.DataFrame(data_rows).reindex(columns=range(len(ref_cols))).fillna('').astype(str).set_axis(ref_cols, axis=1)
+        ref_df = ref_df.apply(lambda col: col.str.strip())
+
+        # Rows with data but no item name are reported together in one warning
+        missing_item = ref_df['item'].eq('') & ref_df[ref_cols[1:]].ne('').any(axis=1)
+        if missing_item.any(): 
+            missing_rows = ', '.join(str(row_num) for row_num in ref_df.index[missing_item] + first_row_num)
+            messages.append(('warning', f"Skipping {int(missing_item.sum())} row(s) in 'reference' sheet with no item name: {missing_rows}."))
+
+        items_df = ref_df[ref_df['item'] != '']
+        item_lower = items_df['item'].str.lower()
+        item_to_unit_lower: Dict[str, str] = dict(zip(item_lower, items_df['unit'].replace('', 'N/A')))
+        item_to_category_lower: Dict[str, str] = dict(zip(item_lower, items_df['category'].replace('', 'Uncategorized')))
+        item_to_subcategory_lower: Dict[str, str] = dict(zip(item_lower, items_df['subcategory'].replace('', 'General')))
+
+        depts_lower = items_df['depts'].str.lower()
+        all_dept_mask = depts_lower.eq('') | depts_lower.eq('all')
+        items_for_all = set(items_df.loc[all_dept_mask, 'item'])
+        per_dept_df = items_df.loc[~all_dept_mask, ['item', 'depts']].assign(dept=lambda d: d['depts'].str.split(',')).explode('dept')
+        per_dept_df = per_dept_df[per_dept_df['dept'].str.strip().isin(valid_departments)]
+        dept_item_sets = per_dept_df.groupby(per_dept_df['dept'].str.strip())['item'].agg(lambda s: set(s)).to_dict()
+
+        # Deduplicated as sets; each department's list is sorted once here
+        dept_to_items_map: DefaultDict[str, List[str]] = defaultdict(list)
+        for dept_name in valid_departments:
+            dept_items = dept_item_sets.get(dept_name, set()) | items_for_all
+            if dept_items:
+                dept_to_items_map[dept_name] = sorted(dept_items)
             
-        return dept_to_items_map, item_to_unit_lower, item_to_category_lower, item_to_subcategory_lower
+        return dept_to_items_map, item_to_unit_lower, item_to_category_lower, item_to_subcategory_lower, messages
     except gspread.exceptions.APIError as e:
-        st.error(f"API Error loading reference: {e}")
+        messages.append(('error', f"API Error loading reference: {e}"))
     except IndexError:
-        st.error("Error reading reference sheet. Ensure 5 columns: Item, Unit, Permitted Depts, Category, Sub-Category.")
+        messages.append(('error', "Error reading reference sheet. Ensure 5 columns: Item, Unit, Permitted Depts, Category, Sub-Category."))
     except Exception as e:
-        st.error(f"Error loading reference: {e}")
-    return defaultdict(list), {}, {}, {}
+        messages.append(('error', f"Error loading reference: {e}"))
+    return defaultdict(list), {}, {}, {}, messages
+
+# --- Function to Load Log Data (Cached) ---
+# refresh_window only keys the cache: each LOG_REFRESH_SECONDS window gets its own read of the sheet.
+# Like get_reference_data, errors are returned as (level, text) messages rather than shown from here.
+@st.cache_data(ttl=LOG_REFRESH_SECONDS, show_spinner=False)
+def load_indent_log_data(_log_sheet: Optional[Worksheet], refresh_window: int = 0) -> Tuple[pd.DataFrame, List[Tuple[str, str]]]:
+    if not _log_sheet: return pd.DataFrame(), []
+    try:
+        expected_cols = LOG_COLUMNS
+        # Plain list-of-lists read of the log columns only; header row becomes the column index without per-row dicts
+        raw = get_sheet_values(_log_sheet, 'A:I')
+        if len(raw) < 2: 
+            return pd.DataFrame(columns=expected_cols), []
+        # The API trims trailing blank cells, so short rows are padded out to the header width
+        header = raw[0]
+        df = pd.DataFrame(raw[1:]).reindex(columns=range(len(header))).fillna('').set_axis(header, axis=1).reindex(columns=expected_cols)
+        # One typed pass for the text columns, then the two date parses and the Qty coercion
+        df = df.astype({col: str for col in ['Item', 'Unit', 'Note', 'MRN', 'Department', 'Requested By']})
+        # Free-text columns on Arrow-backed strings so Tab 2's contains() runs in Arrow kernels
+        df = df.astype({col: 'string[pyarrow]' for col in ['MRN', 'Item', 'Note']})
+        # Lower-cased search keys for Tab 2, computed once per load instead of per filter keystroke
+        df['_mrn_lc'] = df['MRN'].str.lower()
+        df['_item_lc'] = df['Item'].str.lower()
+        # Fixed-format parse for the timestamps this app writes; anything else (older or hand-edited rows) is parsed per value
+        timestamps = pd.to_datetime(df['Timestamp'], format='%Y-%m-%d %H:%M:%S', errors='coerce', cache=True)
+        unparsed = timestamps.isna() & df['Timestamp'].str.strip().ne('')
+        if unparsed.any(): 
+            timestamps[unparsed] = pd.to_datetime(df.loc[unparsed, 'Timestamp'], errors='coerce')
+        df['Timestamp'] = timestamps
+        # Normalised once here so Tab 2 can compare against the filter dates directly
+        df['Date Required'] = pd.to_datetime(df['Date Required'], format='%d-%m-%Y', errors='coerce', cache=True).dt.normalize()
+        df['Qty'] = pd.to_numeric(df['Qty'], errors='coerce').fillna(0.0)
+        df = df.dropna(subset=['Timestamp'])
+        # Few distinct values across many rows: categoricals keep memory and the Arrow payload to the browser small,
+        # and the (Department, Item) groupbys work on integer codes; Item's search key stays in _item_lc.
+        # Built after the dropna so the categories (Tab 2's filter options) only hold values of rows that are kept.
+        df = df.astype({col: 'category' for col in ['Department', 'Requested By', 'Unit', 'Item']})
+        # Stable so the item rows of one indent (which share a timestamp) stay in sheet order
+        return df.sort_values(by='Timestamp', ascending=False, na_position='last', kind='stable'), []
+    except gspread.exceptions.APIError as e: 
+        return pd.DataFrame(), [('error', f"API Error loading log: {e}")]
+    except Exception as e: 
+        return pd.DataFrame(), [('error', f"Error loading/cleaning log: {e}")]
+
+def log_refresh_window() -> int:
+    """Index of the current LOG_REFRESH_SECONDS window; a session's log copy is re-read once it changes."""
+    return int(time.time() // LOG_REFRESH_SECONDS)
+
+
+def substring_mask(values: pd.Series, needle: str) -> np.ndarray:
+    """Boolean array of rows whose (already lower-cased) text contains needle as a literal substring; missing values count as no match."""
+    return values.str.contains(needle, regex=False).to_numpy(dtype=bool, na_value=False)
+
+
+def date_range_mask(log_df: pd.DataFrame, start: date, end: date) -> np.ndarray:
+    """Boolean array of rows with Date Required in [start, end], found by binary search on a per-frame sorted date order."""
+    cached = st.session_state.get('_log_date_order')
+    if not cached or cached[0] is not log_df: 
+        dates = log_df['Date Required'].to_numpy()
+        valid_positions = np.flatnonzero(~np.isnat(dates))
+        order = valid_positions[np.argsort(dates[valid_positions], kind='stable')]
+        cached = (log_df, dates[order], order)
+        st.session_state['_log_date_order'] = cached
+    _, sorted_dates, order = cached
+    # Date Required is normalized at load, so the picked days compare directly as datetime64 values
+    lo = np.searchsorted(sorted_dates, np.datetime64(start, 'D').astype(sorted_dates.dtype), side='left')
+    hi = np.searchsorted(sorted_dates, np.datetime64(end, 'D').astype(sorted_dates.dtype), side='right')
+    mask = np.zeros(len(log_df), dtype=bool)
+    mask[order[lo:hi]] = True
+    return mask
+
+
+def log_filter_options(log_df: pd.DataFrame) -> Tuple[List[str], List[str], Any, Any]:
+    """Department/requester options and the Date Required bounds for Tab 2, computed once per log frame."""
+    cached = st.session_state.get('_log_filter_options')
+    if not cached or cached[0] is not log_df: 
+        # Both columns are categorical with sorted categories, so the option lists come straight from them
+        dept_options = [d for d in log_df['Department'].cat.categories if d]
+        requester_options = [r for r in log_df['Requested By'].cat.categories if r]
+        dates = log_df['Date Required']
+        cached = (log_df, dept_options, requester_options, dates.min(), dates.max())
+        st.session_state['_log_filter_options'] = cached
+    return cached[1:]
+
+
+def build_prefix_index(options: Tuple[str, ...]) -> Dict[str, List[int]]:
+    """Maps each lower-cased 1-3 character prefix to the positions of the options that start with it."""
+    prefix_index: DefaultDict[str, List[int]] = defaultdict(list)
+    for idx, option in enumerate(options): 
+        lowered = option.lower()
+        for n in range(1, min(3, len(lowered)) + 1): 
+            prefix_index[lowered[:n]].append(idx)
+    return dict(prefix_index)
+
+
+def filter_item_options(options: Tuple[str, ...], prefix_index: Dict[str, List[int]], query: str) -> Tuple[str, ...]:
+    """Blank option plus the first ITEM_FILTER_LIMIT options starting with query, looked up through the prefix index."""
+    matches = [options[idx] for idx in prefix_index.get(query[:3], []) if options[idx].lower().startswith(query)]
+    return ("",) + tuple(matches[:ITEM_FILTER_LIMIT])
+
+
+def script_ctx_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Thread pool whose workers carry this run's script context for st.cache_* lookups; submitted work must not write elements."""
+    script_ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=lambda: add_script_run_ctx(threading.current_thread(), script_ctx))
+
 
 # --- Load Reference Data and Initialize State ---
 if 'data_loaded' not in st.session_state: 
     st.session_state.data_loaded = False
 
+# Cold session: the reference and log reads are independent round-trips, so overlap them.
+# The workers only run the element-free cached loaders; the spinner and any messages stay on the script thread.
+prefetched_reference = None
+if not st.session_state.data_loaded and reference_sheet and 'log_df' not in st.session_state:
+    st.session_state['_log_window'] = log_refresh_window()
+    with st.spinner("Fetching item reference data and indent history..."): 
+        with script_ctx_executor(max_workers=2) as executor:
+            reference_future = executor.submit(get_reference_data, reference_sheet)
+            log_future = executor.submit(load_indent_log_data, log_sheet, st.session_state['_log_window'])
+        prefetched_reference = reference_future.result()
+        st.session_state.log_df, log_messages = log_future.result()
+    show_load_messages(log_messages)
+
 if not st.session_state.data_loaded and reference_sheet:
-    dept_map, unit_map, cat_map, subcat_map = get_reference_data(reference_sheet)
+    if prefetched_reference is None: 
+        with st.spinner("Fetching item reference data..."): 
+            prefetched_reference = get_reference_data(reference_sheet)
+    dept_map, unit_map, cat_map, subcat_map, reference_messages = prefetched_reference
+    show_load_messages(reference_messages)
     st.session_state['dept_items_map'] = dept_map
     st.session_state['item_to_unit_lower'] = unit_map
     st.session_state['item_to_category_lower'] = cat_map
     st.session_state['item_to_subcategory_lower'] = subcat_map
-    st.session_state['available_items_for_dept'] = [""] 
+    st.session_state['available_items_for_dept'] = ("",) 
+    st.session_state['available_item_index'] = {"": 0}
     st.session_state.data_loaded = True
 elif not reference_sheet and not st.session_state.data_loaded: 
     st.error("Cannot load reference data.")
@@ -155,15 +324,24 @@ elif not reference_sheet and not st.session_state.data_loaded:
     st.session_state['item_to_unit_lower'] = {}
     st.session_state['item_to_category_lower'] = {}
     st.session_state['item_to_subcategory_lower'] = {}
-    st.session_state['available_items_for_dept'] = [""]
+    st.session_state['available_items_for_dept'] = ("",)
+    st.session_state['available_item_index'] = {"": 0}
+
+if '_next_item_id' not in st.session_state: st.session_state._next_item_id = 0
+
+def new_item_id() -> str:
+    """Returns the next per-session row id."""
+    st.session_state._next_item_id += 1
+    return f"item_{st.session_state._next_item_id}"
 
 if "form_items" not in st.session_state or not isinstance(st.session_state.form_items, list) or not st.session_state.form_items:
-    st.session_state.form_items = [{'id': f"item_{time.time_ns()}", 'item': None, 'qty': 1.0, 
-                                    'note': '', 'unit': '-', 'category': None, 'subcategory': None}] 
+    st.session_state.form_items = [{'id': new_item_id(), 'item': None, 'qty': 1.0, 
+                                    'note': '', 'unit': '-', 'category': None, 'subcategory': None, '_ready': None}] 
 else:
     for item_d in st.session_state.form_items:
         item_d.setdefault('category', None)
         item_d.setdefault('subcategory', None)
+        item_d.setdefault('_ready', None)
         item_d.setdefault('qty', float(item_d.get('qty', 1.0)))
         if 'item_search_term' in item_d: 
             del item_d['item_search_term']
@@ -173,35 +351,23 @@ if 'last_dept' not in st.session_state: st.session_state.last_dept = None
 if 'submitted_data_for_summary' not in st.session_state: st.session_state.submitted_data_for_summary = None
 if 'num_items_to_add' not in st.session_state: st.session_state.num_items_to_add = 1
 if 'requested_by' not in st.session_state: st.session_state.requested_by = ""
+if '_form_version' not in st.session_state: st.session_state._form_version = 0
+
+# --- Top Items by Count (shared by both suggestion calculators) ---
+def top_items_from_counts(log_df: pd.DataFrame, top_n: int) -> Dict[str, List[str]]:
+    """Returns each department's top N items by order count, using one grouped count instead of per-group value_counts."""
+    # Department and Item are categorical from the loader, so both group keys are int codes
+    counts = log_df[['Department', 'Item']].groupby(['Department', 'Item'], observed=True, sort=False).size().rename('n').reset_index()
+    counts = counts.sort_values(['Department', 'n'], ascending=[True, False], kind='stable')
+    top = counts.groupby('Department', observed=True, sort=False).head(top_n)
+    return top.astype({'Item': str}).groupby('Department', observed=True)['Item'].agg(list).to_dict()
+
+
+def drop_blank_items(log_df: pd.DataFrame) -> pd.DataFrame:
+    """Rows with a non-blank Item, checked once per category label rather than per row."""
+    item_labels = log_df['Item'].cat.categories
+    return log_df[~log_df['Item'].isin(item_labels[item_labels.str.strip() == ''])]
 
-# --- Function to Load Log Data (Cached) ---
-@st.cache_data(ttl=300, show_spinner="Loading indent history...")
-def load_indent_log_data() -> pd.DataFrame:
-    if not log_sheet: return pd.DataFrame()
-    try:
-        records = log_sheet.get_all_records(head=1)
-        if not records: 
-            expected_cols = ['MRN', 'Timestamp', 'Requested By', 'Department', 'Date Required', 'Item', 'Qty', 'Unit', 'Note']
-            return pd.DataFrame(columns=expected_cols)
-        df = pd.DataFrame(records)
-        expected_cols = ['MRN', 'Timestamp', 'Requested By', 'Department', 'Date Required', 'Item', 'Qty', 'Unit', 'Note']
-        for col in expected_cols:
-            if col not in df.columns: df[col] = pd.NA
-        if 'Timestamp' in df.columns: df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
-        if 'Date Required' in df.columns: df['Date Required'] = pd.to_datetime(df['Date Required'], format='%d-%m-%Y', errors='coerce')
-        if 'Qty' in df.columns: df['Qty'] = pd.to_numeric(df['Qty'], errors='coerce').fillna(0.0)
-        for col in ['Item', 'Unit', 'Note', 'MRN', 'Department', 'Requested By']:
-            if col in df.columns: df[col] = df[col].astype(str).fillna('')
-        display_cols = [col for col in expected_cols if col in df.columns]
-        df = df[display_cols]
-        df = df.dropna(subset=['Timestamp'])
-        return df.sort_values(by='Timestamp', ascending=False, na_position='last')
-    except gspread.exceptions.APIError as e: 
-        st.error(f"API Error loading log: {e}")
-        return pd.DataFrame()
-    except Exception as e: 
-        st.error(f"Error loading/cleaning log: {e}")
-        return pd.DataFrame()
 
 # --- Smarter Item Suggestions (Recency Weighted) ---
 @st.cache_data(ttl=3600, show_spinner="Analyzing history for suggestions...")
@@ -217,13 +383,11 @@ def calculate_top_items_per_dept_smarter(log_df: pd.DataFrame, top_n: int = 7, d
         recent_log_df = log_df.copy()
 
     recent_log_df.dropna(subset=['Department', 'Item'], inplace=True)
-    recent_log_df = recent_log_df[recent_log_df['Item'].astype(str).str.strip() != '']
-    recent_log_df['Item'] = recent_log_df['Item'].astype(str)
+    recent_log_df = drop_blank_items(recent_log_df)
     
     if recent_log_df.empty: return {}
     try:
-        top_items = recent_log_df.groupby('Department')['Item'].apply(lambda x: x.value_counts().head(top_n).index.tolist())
-        return top_items.to_dict()
+        return top_items_from_counts(recent_log_df, top_n)
     except Exception as e:
         st.warning(f"Could not calculate smarter top items: {e}")
         return calculate_top_items_per_dept(log_df, top_n) 
@@ -234,78 +398,149 @@ def calculate_top_items_per_dept(log_df: pd.DataFrame, top_n: int = 7) -> Dict[s
     """Calculates the top N most frequent items requested per department from all history."""
     if log_df.empty or 'Department' not in log_df.columns or 'Item' not in log_df.columns: return {}
     log_df_clean = log_df.dropna(subset=['Department', 'Item'])
-    log_df_clean = log_df_clean[log_df_clean['Item'].astype(str).str.strip() != '']
-    log_df_clean['Item'] = log_df_clean['Item'].astype(str)
+    log_df_clean = drop_blank_items(log_df_clean)
     if log_df_clean.empty: return {}
     try:
-        top_items = log_df_clean.groupby('Department')['Item'].apply(lambda x: x.value_counts().head(top_n).index.tolist())
-        return top_items.to_dict()
+        return top_items_from_counts(log_df_clean, top_n)
     except Exception as e: 
         st.warning(f"Could not calculate (original) top items: {e}")
         return {}
 
 # --- Pre-calculation for "Last Ordered Date" and "Median Quantity" ---
 @st.cache_data(ttl=300) 
-def get_last_ordered_dates_map(log_df: pd.DataFrame) -> Dict[Tuple[str, str], str]:
-    """Creates a map of (Item, Department) to last ordered date string."""
-    if log_df.empty or 'Item' not in log_df.columns or 'Department' not in log_df.columns or 'Timestamp' not in log_df.columns:
-        return {}
-    idx = log_df.groupby(['Department', 'Item'])['Timestamp'].idxmax()
-    last_ordered_df = log_df.loc[idx]
-    
-    last_ordered_map = {}
-    for _, row in last_ordered_df.iterrows():
-        last_ordered_map[(row['Item'], row['Department'])] = row['Timestamp'].strftime("%d-%b-%Y")
-    return last_ordered_map
-
-@st.cache_data(ttl=300)
-def get_median_order_quantities_map(log_df: pd.DataFrame) -> Dict[Tuple[str, str], float]:
-    """Creates a map of (Item, Department) to median order quantity."""
-    if log_df.empty or 'Item' not in log_df.columns or 'Department' not in log_df.columns or 'Qty' not in log_df.columns:
-        return {}
-    log_df_copy = log_df.copy() 
-    log_df_copy['Qty'] = pd.to_numeric(log_df_copy['Qty'], errors='coerce')
-    median_qtys = log_df_copy.groupby(['Department', 'Item'])['Qty'].median()
-    return median_qtys.to_dict()
+def get_item_history_maps(log_df: pd.DataFrame) -> Tuple[Dict[Tuple[str, str], str], Dict[Tuple[str, str], float]]:
+    """Creates maps of (Item, Department) to last ordered date string and to median order quantity in one grouped pass."""
+    if log_df.empty or not {'Item', 'Department', 'Timestamp', 'Qty'}.issubset(log_df.columns):
+        return {}, {}
+    history = log_df.groupby(['Department', 'Item'], observed=True, sort=False).agg(last_ts=('Timestamp', 'max'), median_qty=('Qty', 'median'))
+    keys = list(zip(history.index.get_level_values('Item'), history.index.get_level_values('Department')))
+    last_ordered_map = dict(zip(keys, history['last_ts'].dt.strftime("%d-%b-%Y")))
+    median_qty_map = dict(zip(keys, history['median_qty'].tolist()))
+    return last_ordered_map, median_qty_map
 
 
 # --- Load historical data & Calculate suggestions & Pre-calculate maps ---
-log_data_for_analysis = load_indent_log_data() 
-top_items_map = calculate_top_items_per_dept_smarter(log_data_for_analysis, top_n=TOP_N_SUGGESTIONS, days_recency=90) 
-if not top_items_map: 
-    top_items_map = calculate_top_items_per_dept(log_data_for_analysis, top_n=TOP_N_SUGGESTIONS)
-st.session_state['top_items_map'] = top_items_map
-
-st.session_state['last_ordered_dates_map'] = get_last_ordered_dates_map(log_data_for_analysis)
-st.session_state['median_quantities_map'] = get_median_order_quantities_map(log_data_for_analysis)
+# The session keeps its own copy of the log; submits are merged into it rather than forcing a re-fetch.
+# The copy is re-read once the refresh window moves on, so other users' indents still show up.
+if 'log_df' in st.session_state and st.session_state.get('_log_window') != log_refresh_window(): 
+    st.session_state.pop('log_df')
+if 'log_df' not in st.session_state: 
+    st.session_state['_log_window'] = log_refresh_window()
+    with st.spinner("Loading indent history..."): 
+        st.session_state.log_df, log_messages = load_indent_log_data(log_sheet, st.session_state['_log_window'])
+    show_load_messages(log_messages)
+log_data_for_analysis = st.session_state.log_df 
+# Suggestions are computed once per session; submits bump them in place via bump_top_items.
+if 'top_items_map' not in st.session_state: 
+    top_items_map = calculate_top_items_per_dept_smarter(log_data_for_analysis, top_n=TOP_N_SUGGESTIONS, days_recency=90) 
+    if not top_items_map: 
+        top_items_map = calculate_top_items_per_dept(log_data_for_analysis, top_n=TOP_N_SUGGESTIONS)
+    st.session_state['top_items_map'] = top_items_map
+    st.session_state['dept_item_counts'] = {}
+if st.session_state.get('_history_maps_log') is not log_data_for_analysis: 
+    # Only on a new session or when its log frame was replaced (submit/refresh/re-read); other reruns skip hashing the log
+    st.session_state['last_ordered_dates_map'], st.session_state['median_quantities_map'] = get_item_history_maps(log_data_for_analysis)
+    st.session_state['_history_maps_log'] = log_data_for_analysis
+
+
+def bump_top_items(dept: str, items: List[str], days_recency: int = 90):
+    """Adds just-submitted items to the department's counts and re-ranks its suggestions without recounting the log."""
+    dept_counts: Dict[str, Counter] = st.session_state.setdefault('dept_item_counts', {})
+    if dept not in dept_counts: 
+        # Seeded once per department from the log as it was before this submit
+        dept_log = log_data_for_analysis[log_data_for_analysis['Department'] == dept] if not log_data_for_analysis.empty else log_data_for_analysis
+        recent_log = dept_log[dept_log['Timestamp'] >= datetime.now() - timedelta(days=days_recency)] if not dept_log.empty else dept_log
+        if recent_log.empty: 
+            recent_log = dept_log
+        dept_counts[dept] = Counter(item for item in recent_log.get('Item', []) if str(item).strip())
+    dept_counts[dept].update(items)
+    st.session_state['top_items_map'][dept] = [item for item, _ in dept_counts[dept].most_common(TOP_N_SUGGESTIONS)]
+
+
+def merge_submitted_into_log(log_df: pd.DataFrame, mrn: str, timestamp: str, requester: str, dept: str, 
+                             date_required: date, items: List[Tuple[str, float, str, str, str, str]]) -> pd.DataFrame:
+    """Returns the log frame with a just-submitted indent on top, typed the way load_indent_log_data types it."""
+    new_df = pd.DataFrame([(item, round(qty, 3), unit, note if note else "N/A") for item, qty, unit, note, _, _ in items], 
+                          columns=['Item', 'Qty', 'Unit', 'Note'])
+    new_df = new_df.assign(**{'MRN': mrn, 'Timestamp': pd.Timestamp(timestamp), 'Requested By': requester, 
+                              'Department': dept, 'Date Required': pd.Timestamp(date_required)})[LOG_COLUMNS]
+    new_df = new_df.astype({col: 'string[pyarrow]' for col in ['MRN', 'Item', 'Note']})
+    new_df = new_df.assign(_mrn_lc=new_df['MRN'].str.lower(), _item_lc=new_df['Item'].str.lower())
+    merged = pd.concat([new_df, log_df], ignore_index=True) if not log_df.empty else new_df
+    return merged.astype({col: 'category' for col in ['Department', 'Requested By', 'Unit', 'Item']})
+
+
+def refresh_log():
+    """Drops the session's log copy and the cached sheet read so the next run re-fetches the log."""
+    load_indent_log_data.clear()
+    st.session_state.pop('log_df', None)
+
+
+def refresh_suggestions():
+    """Drops the session's suggestions and cached counts so the next run recomputes them from the log."""
+    calculate_top_items_per_dept_smarter.clear()
+    st.session_state.pop('top_items_map', None)
+    st.session_state.pop('dept_item_counts', None)
 
 
 # --- MRN Generation ---
 def generate_mrn() -> str:
     if not log_sheet: return f"MRN-ERR-NOSHEET"
+    # Read only the tail of column A, starting a little above the last known data row.
+    # Once this session has a counter, only rows appended after its last write are checked.
+    cached_next = st.session_state.get('_next_mrn')
+    row_hint = st.session_state.get('_log_last_row') or len(log_data_for_analysis) + 1
+    start_row = row_hint + 1 if cached_next else max(1, row_hint - MRN_TAIL_ROWS)
     try: 
-        all_mrns = log_sheet.col_values(1)
+        tail_values = get_sheet_values(log_sheet, f"A{start_row}:A")
+        last_valid_num = next((int(v[0][4:]) for v in reversed(tail_values) 
+                               if v and v[0].startswith("MRN-") and v[0][4:].isdigit()), 0)
+        if not last_valid_num and cached_next and not tail_values: 
+            last_valid_num = cached_next - 1
+        # Full column only when the tail has no usable MRN (empty tail or legacy values)
+        all_mrns = log_sheet.col_values(1) if not last_valid_num else []
+        st.session_state['_log_last_row'] = len(all_mrns) if all_mrns else start_row + len(tail_values) - 1
         next_number = 1
     except gspread.exceptions.APIError as e: 
+        st.session_state.pop('_next_mrn', None)
         st.error(f"API Error fetching MRNs: {e}")
         return f"MRN-ERR-API-{datetime.now().strftime('%H%M%S')}"
     except Exception as e: 
         st.error(f"Error fetching MRNs: {e}")
         return f"MRN-ERR-EXC-{datetime.now().strftime('%H%M%S')}"
-    if len(all_mrns) > 1:
-        last_valid_num = 0
-        for mrn_str in reversed(all_mrns):
-            if mrn_str and mrn_str.startswith("MRN-") and mrn_str[4:].isdigit(): 
-                last_valid_num = int(mrn_str[4:])
-                break
-        if last_valid_num == 0: 
-            non_empty_count = sum(1 for v in all_mrns if str(v).strip()) 
-            last_valid_num = max(0, non_empty_count - 1)
+    if last_valid_num:
         next_number = last_valid_num + 1
+    elif len(all_mrns) > 1:
+        # Full-column fallback: parse every MRN-<digits> cell in one vectorized pass and continue from the highest
+        mrn_numbers = pd.to_numeric(pd.Series(all_mrns[1:], dtype=str).str.extract(r'^MRN-(\d+)$', expand=False), errors='coerce')
+        if mrn_numbers.notna().any(): 
+            next_number = int(mrn_numbers.max()) + 1
     return f"MRN-{str(next_number).zfill(3)}"
 
 
+# --- Log Writes ---
+def append_log_rows(rows: Iterable[List[Any]]) -> None:
+    """Appends rows to the log sheet in order, chunked, backing off on rate-limit errors."""
+    rows_iter = iter(rows)
+    while True:
+        chunk = list(islice(rows_iter, LOG_APPEND_CHUNK_SIZE))
+        if not chunk: break
+        for attempt in range(LOG_APPEND_MAX_RETRIES + 1):
+            try:
+                log_sheet.append_rows(chunk, value_input_option='USER_ENTERED')
+                break
+            except gspread.exceptions.APIError as e:
+                # Only 429 is retried: the request was rejected unapplied, whereas a 503 may come back after the rows were written
+                status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status_code != 429 or attempt == LOG_APPEND_MAX_RETRIES: raise
+                time.sleep(2 ** attempt)
+
+
 # --- PDF Generation Function ---
+def pdf_text(value: Any) -> str:
+    """Text for the PDF's core (Latin-1) font; characters it can't encode become '?' instead of failing the whole PDF."""
+    return str(value).encode('latin-1', 'replace').decode('latin-1')
+
 def create_indent_pdf(data: Dict[str, Any]) -> bytes:
     pdf = FPDF()
     pdf.add_page()
@@ -315,10 +550,10 @@ def create_indent_pdf(data: Dict[str, Any]) -> bytes:
     pdf.cell(0, 10, "Material Indent Request", ln=True, align='C')
     pdf.ln(8)
     pdf.set_font("Helvetica", "", 11)
-    pdf.cell(95, 6, f"MRN: {data.get('mrn', 'N/A')}", ln=0)
-    pdf.cell(95, 6, f"Requested By: {data.get('requester', 'N/A')}", ln=1, align='R')
-    pdf.cell(95, 6, f"Department: {data.get('dept', 'N/A')}", ln=0)
-    pdf.cell(95, 6, f"Date Required: {data.get('date', 'N/A')}", ln=1, align='R')
+    pdf.cell(95, 6, pdf_text(f"MRN: {data.get('mrn', 'N/A')}"), ln=0)
+    pdf.cell(95, 6, pdf_text(f"Requested By: {data.get('requester', 'N/A')}"), ln=1, align='R')
+    pdf.cell(95, 6, pdf_text(f"Department: {data.get('dept', 'N/A')}"), ln=0)
+    pdf.cell(95, 6, pdf_text(f"Date Required: {data.get('date', 'N/A')}"), ln=1, align='R')
     pdf.ln(6)
     pdf.set_font("Helvetica", "B", 10)
     pdf.set_fill_color(230, 230, 230)
@@ -327,53 +562,79 @@ def create_indent_pdf(data: Dict[str, Any]) -> bytes:
     pdf.cell(col_widths['qty'], 7, "Qty", border=1, ln=0, align='C', fill=True)
     pdf.cell(col_widths['unit'], 7, "Unit", border=1, ln=0, align='C', fill=True)
     pdf.cell(col_widths['note'], 7, "Note", border=1, ln=1, align='C', fill=True)
-    current_category = None
-    current_subcategory = None
+    # Column left edges and total table width, fixed for the whole table
+    col_x = [pdf.l_margin]
+    for width in col_widths.values(): col_x.append(col_x[-1] + width)
+    table_right = col_x[-1]
+    # Text width available inside each column, fixed for the whole table
+    usable_widths = [width - 2 * pdf.c_margin for width in col_widths.values()]
+    line_height = 5.5
     items_data = data.get('items', [])
     if not isinstance(items_data, list): items_data = []
-    for item_tuple in items_data:
-        if len(item_tuple) < 6: continue
-        item, qty_val, unit, note, category, subcategory = item_tuple 
-        category = category or "Uncategorized"
-        subcategory = subcategory or "General"
+    # Items arrive sorted by category/sub-category, so each group's headings and body font are set once per group
+    item_groups = groupby((item_tuple for item_tuple in items_data if len(item_tuple) >= 6), 
+                          key=lambda item_tuple: (item_tuple[4] or "Uncategorized", item_tuple[5] or "General"))
+    current_category = None
+    for (category, subcategory), group_items in item_groups:
         if category != current_category: 
             pdf.ln(3)
             pdf.set_font("Helvetica", "B", 10)
             pdf.set_fill_color(210, 210, 210)
-            pdf.cell(0, 6, f"Category: {category}", ln=1, align='L', fill=True, border='LTRB')
+            pdf.cell(0, 6, pdf_text(f"Category: {category}"), ln=1, align='L', fill=True, border='LTRB')
             current_category = category
-            current_subcategory = None
             pdf.set_fill_color(230, 230, 230)
-        if subcategory != current_subcategory: 
-            pdf.ln(1)
-            pdf.set_font("Helvetica", "BI", 9)
-            pdf.cell(0, 5, f"  Sub-Category: {subcategory}", ln=1, align='L')
-            current_subcategory = subcategory
+        pdf.ln(1)
+        pdf.set_font("Helvetica", "BI", 9)
+        pdf.cell(0, 5, pdf_text(f"  Sub-Category: {subcategory}"), ln=1, align='L')
         pdf.set_font("Helvetica", "", 9)
-        line_height = 5.5
-        start_y = pdf.get_y()
-        pdf.multi_cell(col_widths['item'], line_height, str(item), border='LR', align='L')
-        y1 = pdf.get_y()
-        pdf.set_xy(pdf.l_margin + col_widths['item'], start_y)
-        pdf.multi_cell(col_widths['qty'], line_height, f"{float(qty_val):.3f}", border='R', align='C') 
-        y2 = pdf.get_y()
-        pdf.set_xy(pdf.l_margin + col_widths['item'] + col_widths['qty'], start_y)
-        pdf.multi_cell(col_widths['unit'], line_height, str(unit), border='R', align='C')
-        y3 = pdf.get_y()
-        pdf.set_xy(pdf.l_margin + col_widths['item'] + col_widths['qty'] + col_widths['unit'], start_y)
-        pdf.multi_cell(col_widths['note'], line_height, str(note if note else "-"), border='R', align='L')
-        y4 = pdf.get_y()
-        final_y = max(start_y + line_height, y1, y2, y3, y4)
-        pdf.line(pdf.l_margin, final_y, pdf.l_margin + sum(col_widths.values()), final_y)
-        pdf.set_y(final_y)
-        pdf.ln(0.1)
+        for item, qty_val, unit, note, _, _ in group_items:
+            # Sanitised once per row, so neither the width check nor the cells re-encode
+            row_texts = [pdf_text(item), f"{float(qty_val):.3f}", pdf_text(unit), pdf_text(note if note else "-")]
+            # Single-line rows go out as plain cells; multi_cell (which measures and wraps) only when something wraps
+            if all(pdf.get_string_width(text) <= usable_width for text, usable_width in zip(row_texts, usable_widths)):
+                pdf.cell(col_widths['item'], line_height, row_texts[0], border='LR', ln=0, align='L')
+                pdf.cell(col_widths['qty'], line_height, row_texts[1], border='R', ln=0, align='C')
+                pdf.cell(col_widths['unit'], line_height, row_texts[2], border='R', ln=0, align='C')
+                pdf.cell(col_widths['note'], line_height, row_texts[3], border='R', ln=0, align='L')
+                final_y = pdf.get_y() + line_height
+                pdf.line(pdf.l_margin, final_y, table_right, final_y)
+                pdf.set_y(final_y)
+                pdf.ln(0.1)
+                continue
+            start_y = pdf.get_y()
+            pdf.multi_cell(col_widths['item'], line_height, row_texts[0], border='LR', align='L')
+            y1 = pdf.get_y()
+            pdf.set_xy(col_x[1], start_y)
+            pdf.multi_cell(col_widths['qty'], line_height, row_texts[1], border='R', align='C') 
+            y2 = pdf.get_y()
+            pdf.set_xy(col_x[2], start_y)
+            pdf.multi_cell(col_widths['unit'], line_height, row_texts[2], border='R', align='C')
+            y3 = pdf.get_y()
+            pdf.set_xy(col_x[3], start_y)
+            pdf.multi_cell(col_widths['note'], line_height, row_texts[3], border='R', align='L')
+            y4 = pdf.get_y()
+            final_y = max(start_y + line_height, y1, y2, y3, y4)
+            pdf.line(pdf.l_margin, final_y, table_right, final_y)
+            pdf.set_y(final_y)
+            pdf.ln(0.1)
     
-    pdf_output_data = pdf.output(dest='S') 
-    if isinstance(pdf_output_data, bytearray):
-        return bytes(pdf_output_data) 
-    elif isinstance(pdf_output_data, str): 
-        return pdf_output_data.encode('latin-1')
-    return pdf_output_data 
+    # st.download_button rejects bytearray, so fpdf2's output is converted once; get_indent_pdf caches the result per MRN
+    return bytes(pdf.output())
+
+@st.cache_data(max_entries=20, show_spinner=False)
+def get_indent_pdf(mrn: str, data: Dict[str, Any]) -> bytes:
+    """Returns the PDF bytes for a submitted indent, built once per MRN and payload."""
+    return create_indent_pdf(data)
+
+def get_whatsapp_url(mrn: str, dept: str, requester: str, date_str: str) -> str:
+    """Builds the WhatsApp share link for a submitted indent (a short quote_plus, cheaper to redo than to cache)."""
+    wa_text = (f"Indent Submitted:\nMRN: {mrn}\n"
+               f"Department: {dept}\n"
+               f"Requested By: {requester}\n"
+               f"Date Required: {date_str}\n\n"
+               "Please see attached PDF for item details.")
+    encoded_text = urllib.parse.quote_plus(wa_text)
+    return f"https://wa.me/?text={encoded_text}"
 
 
 # --- UI Tabs ---
@@ -381,22 +642,71 @@ tab1, tab2 = st.tabs(["📝 New Indent", "📊 View Indents"])
 
 # --- TAB 1: New Indent Form ---
 with tab1:
+    def mark_form_changed():
+        st.session_state._form_version += 1
+
+    def submit_ready_fields(unit: str, category: Optional[str], subcategory: Optional[str]) -> Optional[Tuple[str, str, str]]:
+        """(unit, category, subcategory) as written on submit, or None when the item has no unit and will be skipped."""
+        if unit == '-': return None
+        return unit, category or "Uncategorized", subcategory or "General"
+
+    def get_form_derived() -> Tuple[bool, Set[str], List[Tuple[str, float, str, str, str, str]], List[str], Set[str]]:
+        """Single pass over form_items for validity, duplicates, submit-ready rows and selected names, cached per form version."""
+        cached = st.session_state.get('_form_derived')
+        if cached and cached[0] == st.session_state._form_version:
+            return cached[1:]
+        has_valid = False
+        seen_items: Set[str] = set()
+        duplicate_items: Set[str] = set()
+        ready_rows: List[Tuple[str, float, str, str, str, str]] = []
+        unitless_items: List[str] = []
+        for item_d in st.session_state.form_items:
+            selected_name = item_d.get('item')
+            if not selected_name: continue
+            if selected_name in seen_items: duplicate_items.add(selected_name)
+            else: seen_items.add(selected_name)
+            qty = float(item_d.get('qty', 0.0))
+            if qty <= 0: continue
+            has_valid = True
+            ready = item_d.get('_ready')
+            if ready:
+                unit, category, subcategory = ready
+                ready_rows.append(( selected_name, qty, unit, item_d.get('note', ''), category, subcategory ))
+            else:
+                unitless_items.append(selected_name)
+        st.session_state._form_derived = (st.session_state._form_version, has_valid, duplicate_items, ready_rows, unitless_items, seen_items)
+        return has_valid, duplicate_items, ready_rows, unitless_items, seen_items
+
+    def lookup_item_details(item_name: Optional[str]) -> Tuple[str, Optional[str], Optional[str]]:
+        """Unit, category and sub-category for an item name from the reference maps."""
+        if not item_name: return "-", None, None
+        item_lower = item_name.lower()
+        unit = st.session_state.get("item_to_unit_lower", {}).get(item_lower, "-")
+        category = st.session_state.get("item_to_category_lower", {}).get(item_lower)
+        subcategory = st.session_state.get("item_to_subcategory_lower", {}).get(item_lower)
+        return unit if unit else "-", category, subcategory
+
     def add_item(count=1):
         if not isinstance(count, int) or count < 1: count = 1
+        mark_form_changed()
         for _ in range(count): 
-            new_id = f"item_{time.time_ns()}"
+            new_id = new_item_id()
             st.session_state.form_items.append({'id': new_id, 'item': None, 'qty': 1.0, 
-                                                 'note': '', 'unit': '-', 'category': None, 'subcategory': None}) 
+                                                 'note': '', 'unit': '-', 'category': None, 'subcategory': None, '_ready': None}) 
 
     def remove_item(item_id): 
+        apply_item_edits()
         st.session_state.form_items = [item for item in st.session_state.form_items if item['id'] != item_id]
+        mark_form_changed()
         if not st.session_state.form_items: add_item(count=1)
 
     def clear_all_items(): 
-        st.session_state.form_items = [{'id': f"item_{time.time_ns()}", 'item': None, 'qty': 1.0, 
-                                         'note': '', 'unit': '-', 'category': None, 'subcategory': None}]
+        mark_form_changed()
+        st.session_state.form_items = [{'id': new_item_id(), 'item': None, 'qty': 1.0, 
+                                         'note': '', 'unit': '-', 'category': None, 'subcategory': None, '_ready': None}]
 
     def handle_add_items_click(): 
+        apply_item_edits()
         num_to_add = st.session_state.get('num_items_to_add', 1)
         add_item(count=num_to_add)
 
@@ -407,75 +717,111 @@ with tab1:
                 st.toast(f"'{item_name_to_add}' is already in the list.", icon="ℹ️")
                 return
 
-            unit_map = st.session_state.get("item_to_unit_lower", {})
-            cat_map = st.session_state.get("item_to_category_lower", {})
-            subcat_map = st.session_state.get("item_to_subcategory_lower", {})
-            item_lower = item_name_to_add.lower()
-            unit = unit_map.get(item_lower, "-")
-            unit = unit if unit else "-"
-            category = cat_map.get(item_lower)
-            subcategory = subcat_map.get(item_lower)
+            unit, category, subcategory = lookup_item_details(item_name_to_add)
 
+            mark_form_changed()
             first_blank_row_index = -1
             if st.session_state.form_items and st.session_state.form_items[0].get('item') is None:
                 first_blank_row_index = 0
             
             if first_blank_row_index == 0: 
+                reset_row_widgets(st.session_state.form_items[0]['id'])
                 st.session_state.form_items[0]['item'] = item_name_to_add
                 st.session_state.form_items[0]['qty'] = 1.0
                 st.session_state.form_items[0]['unit'] = unit
                 st.session_state.form_items[0]['category'] = category
                 st.session_state.form_items[0]['subcategory'] = subcategory
+                st.session_state.form_items[0]['_ready'] = submit_ready_fields(unit, category, subcategory)
+                st.session_state.form_items[0].pop('_label_cache', None)
                 st.session_state.form_items[0]['note'] = '' 
             else: 
-                new_id = f"item_{time.time_ns()}"
+                new_id = new_item_id()
                 st.session_state.form_items.append({'id': new_id, 'item': item_name_to_add, 'qty': 1.0, 
-                                                     'note': '', 'unit': unit, 'category': category, 'subcategory': subcategory})
+                                                     'note': '', 'unit': unit, 'category': category, 'subcategory': subcategory,
+                                                     '_ready': submit_ready_fields(unit, category, subcategory)})
 
 
     def department_changed_callback():
         selected_dept = st.session_state.get("selected_dept")
-        dept_map = st.session_state.get("dept_items_map", defaultdict(list))
-        available_items = [""] 
-        if selected_dept and selected_dept in dept_map: 
-            specific_items = dept_map.get(selected_dept, [])
-            available_items.extend(specific_items) 
-        st.session_state.available_items_for_dept = available_items
-        for i in range(len(st.session_state.form_items)): 
-            st.session_state.form_items[i]['item'] = None
-            st.session_state.form_items[i]['unit'] = '-'
-            st.session_state.form_items[i]['qty'] = 1.0 
-            st.session_state.form_items[i]['note'] = ''
-            st.session_state.form_items[i]['category'] = None
-            st.session_state.form_items[i]['subcategory'] = None
-
-
-    def item_selected_callback(item_id: str, selectbox_key: str):
-        """Callback for when an item is selected using the standard dropdown."""
-        unit_map = st.session_state.get("item_to_unit_lower", {})
-        cat_map = st.session_state.get("item_to_category_lower", {})
-        subcat_map = st.session_state.get("item_to_subcategory_lower", {})
-        
-        selected_item_name = st.session_state.get(selectbox_key)
-        
-        unit = "-"
-        category = None
-        subcategory = None
-
-        if selected_item_name:
-            item_lower = selected_item_name.lower()
-            unit = unit_map.get(item_lower, "-")
-            unit = unit if unit else "-"
-            category = cat_map.get(item_lower)
-            subcategory = subcat_map.get(item_lower)
-            
-        for i, item_dict_loop in enumerate(st.session_state.form_items):
-            if item_dict_loop['id'] == item_id:
-                st.session_state.form_items[i]['item'] = selected_item_name if selected_item_name else None
-                st.session_state.form_items[i]['unit'] = unit
-                st.session_state.form_items[i]['category'] = category
-                st.session_state.form_items[i]['subcategory'] = subcategory
-                break
+        dept_map = st.session_state.get("dept_items_map", {})
+        # Immutable option tuple and option -> selectbox index, built once per department per session
+        dept_options_cache = st.session_state.setdefault('_dept_options_cache', {})
+        if selected_dept not in dept_options_cache: 
+            # Reference lists are already unique and sorted by get_reference_data
+            options = ("",) + tuple(dept_map.get(selected_dept, [])) if selected_dept else ("",)
+            # Long lists also get a prefix index for the item filter box
+            prefix_index = build_prefix_index(options) if len(options) > ITEM_FILTER_MIN_OPTIONS else None
+            dept_options_cache[selected_dept] = (options, {option: idx for idx, option in enumerate(options)}, prefix_index)
+        (st.session_state.available_items_for_dept, st.session_state.available_item_index, 
+         st.session_state.available_item_prefix_index) = dept_options_cache[selected_dept]
+        mark_form_changed()
+        for row in st.session_state.form_items: 
+            reset_row_widgets(row['id'])
+            row.update(item=None, unit='-', qty=1.0, note='', category=None, subcategory=None, _ready=None)
+            row.pop('_label_cache', None)
+
+
+    def set_row_item(row: Dict[str, Any], selected_item_name: Optional[str]):
+        """Stores the chosen item on a row along with its resolved unit/category."""
+        unit, category, subcategory = lookup_item_details(selected_item_name)
+        mark_form_changed()
+        row.update(item=selected_item_name if selected_item_name else None, unit=unit, category=category, subcategory=subcategory, 
+                   _ready=submit_ready_fields(unit, category, subcategory))
+        row.pop('_label_cache', None)
+
+    def reset_row_widgets(item_id: str):
+        """Drops a row's widget state so its widgets re-initialise from form_items on the next run."""
+        for key_prefix in ("item_select_", "qty_", "note_"):
+            st.session_state.pop(f"{key_prefix}{item_id}", None)
+
+    def apply_table_edits():
+        """Folds the table-entry editor's edited/added/deleted rows back into form_items."""
+        edits = st.session_state.pop("items_editor", None)
+        if not edits: return
+        mark_form_changed()
+        rows = st.session_state.form_items
+        for position, changes in edits.get("edited_rows", {}).items():
+            row = rows[int(position)]
+            if "Item" in changes:
+                row['item'] = changes["Item"] or None
+                row['unit'], row['category'], row['subcategory'] = lookup_item_details(row['item'])
+                row['_ready'] = submit_ready_fields(row['unit'], row['category'], row['subcategory'])
+            if "Qty" in changes:
+                row['qty'] = float(changes["Qty"]) if changes["Qty"] is not None else 1.0
+            if "Note" in changes:
+                row['note'] = changes["Note"] or ''
+            reset_row_widgets(row['id'])
+        deleted_positions = set(edits.get("deleted_rows", []))
+        if deleted_positions:
+            rows = [row for position, row in enumerate(rows) if position not in deleted_positions]
+        for added in edits.get("added_rows", []):
+            item_name = added.get("Item") or None
+            unit, category, subcategory = lookup_item_details(item_name)
+            rows.append({'id': new_item_id(), 'item': item_name, 'qty': float(added.get("Qty") or 1.0), 
+                         'note': added.get("Note") or '', 'unit': unit, 'category': category, 'subcategory': subcategory,
+                         '_ready': submit_ready_fields(unit, category, subcategory)})
+        st.session_state.form_items = rows
+        if not rows: add_item(count=1)
+
+    def apply_item_edits():
+        """Copies committed item-form widget values back into form_items (form widgets can't carry on_change callbacks)."""
+        if st.session_state.get("bulk_item_entry"):
+            apply_table_edits()
+            return
+        for row in st.session_state.form_items:
+            item_id = row['id']
+            selectbox_key = f"item_select_{item_id}"
+            qty_key = f"qty_{item_id}"
+            note_key = f"note_{item_id}"
+            if selectbox_key in st.session_state and (st.session_state[selectbox_key] or None) != row.get('item'):
+                set_row_item(row, st.session_state[selectbox_key])
+            # st.number_input already hands back a float, so it is stored as-is
+            if qty_key in st.session_state and st.session_state[qty_key] != row.get('qty'): 
+                row['qty'] = st.session_state[qty_key]
+                mark_form_changed()
+            if note_key in st.session_state and st.session_state[note_key] != row.get('note'): 
+                row['note'] = st.session_state[note_key]
+                mark_form_changed()
 
 
     with st.container(border=True): 
@@ -499,274 +845,313 @@ with tab1:
 
     st.divider()
 
+    # Header values for this run; callbacks still read/write st.session_state directly
+    current_dept = dept or ""
+    requester_value = (requester_name or "").strip()
 
     if 'dept_items_map' in st.session_state and 'available_items_for_dept' not in st.session_state: 
         department_changed_callback()
-    elif st.session_state.get("selected_dept") and not st.session_state.get('available_items_for_dept', [""]): 
+    elif current_dept and not st.session_state.get('available_items_for_dept', ("",)): 
         department_changed_callback()
 
-    selected_dept_for_suggestions = st.session_state.get("selected_dept")
-    if selected_dept_for_suggestions and 'top_items_map' in st.session_state:
-        suggestions = st.session_state.top_items_map.get(selected_dept_for_suggestions, [])
-        items_already_in_form = [item_d.get('item') for item_d in st.session_state.form_items if item_d.get('item')]
-        valid_suggestions = [item for item in suggestions if item not in items_already_in_form]
-        if valid_suggestions:
-            st.subheader("✨ Quick Add Common Items (Recently Popular)") 
-            num_suggestion_cols = min(len(valid_suggestions), TOP_N_SUGGESTIONS, 5) 
-            suggestion_cols = st.columns(num_suggestion_cols)
-            for idx, item_name_sugg in enumerate(valid_suggestions[:num_suggestion_cols]): 
-                col_index = idx % num_suggestion_cols
-                with suggestion_cols[col_index]: 
-                    st.button( f"+ {item_name_sugg}", key=f"suggest_{selected_dept_for_suggestions}_{item_name_sugg.replace(' ', '_').replace('/', '_')}", 
-                               on_click=add_suggested_item, args=(item_name_sugg,), use_container_width=True)
-            st.divider()
-
-    st.subheader("Enter Items:")
-
-    current_selected_items_in_form = [ item['item'] for item in st.session_state.form_items if item.get('item') ]
-    duplicate_item_counts = Counter(current_selected_items_in_form)
-    duplicates_found_dict = { item: count for item, count in duplicate_item_counts.items() if count > 1 }
-    items_to_render = list(st.session_state.form_items)
+    @st.fragment
+    def render_item_editor(current_dept: str, requester_value: str, delivery_date: date):
+        """Suggestions, item rows and submit; clicks in here rerun only this part of the page (a submit reruns the app)."""
+        selected_dept_for_suggestions = current_dept
+        if selected_dept_for_suggestions and 'top_items_map' in st.session_state:
+            suggestions = st.session_state.top_items_map.get(selected_dept_for_suggestions, [])
+            items_already_in_form = get_form_derived()[4]
+            valid_suggestions = [item for item in suggestions if item not in items_already_in_form]
+            if valid_suggestions:
+                st.subheader("✨ Quick Add Common Items (Recently Popular)") 
+                num_suggestion_cols = min(len(valid_suggestions), TOP_N_SUGGESTIONS, 5) 
+                suggestion_cols = st.columns(num_suggestion_cols)
+                for idx, item_name_sugg in enumerate(valid_suggestions[:num_suggestion_cols]): 
+                    col_index = idx % num_suggestion_cols
+                    with suggestion_cols[col_index]: 
+                        st.button( f"+ {item_name_sugg}", key=f"suggest_{selected_dept_for_suggestions}_{item_name_sugg.replace(' ', '_').replace('/', '_')}", 
+                                   on_click=add_suggested_item, args=(item_name_sugg,), use_container_width=True)
+                # The suggestions are rebuilt by the module-level block, so this click reruns the whole app, not just the fragment
+                if st.button("↻ Refresh suggestions", key="refresh_suggestions", help="Recount suggestions from the full indent history."): 
+                    refresh_suggestions()
+                    st.rerun()
+                st.divider()
+
+        st.subheader("Enter Items:")
+        bulk_entry = st.toggle("Table entry", key="bulk_item_entry", help="Edit all items in a single table instead of one row at a time.")
+        # Departments with very long item lists get a filter box; each row's dropdown then only carries the matches
+        item_query = ""
+        item_prefix_index = st.session_state.get('available_item_prefix_index')
+        if item_prefix_index is not None and not bulk_entry: 
+            item_query = st.text_input("Filter item list", key="item_filter", placeholder="Type the first letters of an item...").strip().lower()
+
+        # Item rows live in one form so edits across rows are batched into a single rerun
+        with st.form("items_form", border=False, enter_to_submit=False):
+            _, duplicate_items, _, _, _ = get_form_derived()
     
-    # Using pre-calculated maps from session state for performance
-    last_ordered_map = st.session_state.get('last_ordered_dates_map', {})
-    median_qty_map = st.session_state.get('median_quantities_map', {})
-
-    for i, item_dict in enumerate(items_to_render):
-        item_id = item_dict['id']
-        qty_key = f"qty_{item_id}"
-        note_key = f"note_{item_id}"
-        selectbox_key = f"item_select_{item_id}" 
-        
-        if qty_key in st.session_state: 
-            try:
-                st.session_state.form_items[i]['qty'] = float(st.session_state[qty_key]) 
-            except (ValueError, TypeError):
-                 st.session_state.form_items[i]['qty'] = 1.0 
-        if note_key in st.session_state: 
-            st.session_state.form_items[i]['note'] = st.session_state[note_key]
-        
-        current_item_value = st.session_state.form_items[i].get('item')
-        current_qty = float(st.session_state.form_items[i].get('qty', 1.0)) 
-        current_note = st.session_state.form_items[i].get('note', '')
-        current_unit = st.session_state.form_items[i].get('unit', '-')
-        current_category = st.session_state.form_items[i].get('category')
-        current_subcategory = st.session_state.form_items[i].get('subcategory')
-
-        item_label = current_item_value if current_item_value else f"Item #{i+1}"
-        is_duplicate = current_item_value and current_item_value in duplicates_found_dict
-        duplicate_indicator = "⚠️ " if is_duplicate else ""
-        expander_label = f"{duplicate_indicator}**{item_label}**"
-
-        with st.expander(label=expander_label, expanded=True): 
-            if is_duplicate: 
-                st.warning(f"DUPLICATE ITEM: '{current_item_value}' is selected multiple times.", icon="⚠️")
-
-            col1, col2, col3, col4 = st.columns([4, 3, 1, 1]) 
-            with col1: 
-                available_options = st.session_state.get('available_items_for_dept', [""])
-                try: 
-                    current_item_index = available_options.index(current_item_value) if current_item_value in available_options else 0
-                except ValueError: 
-                    current_item_index = 0
-                
-                st.selectbox( 
-                    "Item Select", 
-                    options=available_options, 
-                    index=current_item_index, 
-                    key=selectbox_key, 
-                    placeholder="Select item...", 
-                    label_visibility="collapsed", 
-                    on_change=item_selected_callback, 
-                    args=(item_id, selectbox_key) 
+            # Using pre-calculated maps from session state for performance
+            last_ordered_map = st.session_state.get('last_ordered_dates_map', {})
+            median_qty_map = st.session_state.get('median_quantities_map', {})
+            available_options = st.session_state.get('available_items_for_dept', ("",))
+            option_index_map = st.session_state.get('available_item_index') or {option: idx for idx, option in enumerate(available_options)}
+            row_options, row_index_map = available_options, option_index_map
+            if item_query: 
+                row_options = filter_item_options(available_options, item_prefix_index, item_query)
+                row_index_map = {option: idx for idx, option in enumerate(row_options)}
+
+            if bulk_entry:
+                table_rows = [{'Item': row.get('item'), 'Qty': float(row.get('qty', 1.0)), 'Unit': row.get('unit', '-'), 'Note': row.get('note', '')}
+                              for row in st.session_state.form_items]
+                st.data_editor(
+                    pd.DataFrame(table_rows, columns=["Item", "Qty", "Unit", "Note"]),
+                    key="items_editor",
+                    num_rows="dynamic",
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config={
+                        "Item": st.column_config.SelectboxColumn("Item", options=available_options[1:], width="large"),
+                        "Qty": st.column_config.NumberColumn("Qty", min_value=0.001, step=0.001, format="%.3f"),
+                        "Unit": st.column_config.TextColumn("Unit", disabled=True),
+                        "Note": st.column_config.TextColumn("Note"),
+                    },
                 )
-                st.caption(f"Category: {current_category or '-'} | Sub-Cat: {current_subcategory or '-'}")
-                
-                current_dept_for_filter = st.session_state.get("selected_dept", "") 
-                if current_item_value and current_dept_for_filter:
-                    last_ordered_date_str = last_ordered_map.get((current_item_value, current_dept_for_filter))
-                    if last_ordered_date_str:
-                        st.caption(f"Last ordered by {current_dept_for_filter}: {last_ordered_date_str}")
+            else:
+                form_items = st.session_state.form_items
+                show_remove_buttons = len(form_items) > 1
+                for i, row in enumerate(form_items):
+                    item_id = row['id']
+                    qty_key = f"qty_{item_id}"
+                    note_key = f"note_{item_id}"
+                    selectbox_key = f"item_select_{item_id}" 
+        
+                    current_item_value = row.get('item')
+                    current_qty = float(row.get('qty', 1.0)) 
+                    current_note = row.get('note', '')
+                    current_unit = row.get('unit', '-')
+                    current_category = row.get('category')
+                    current_subcategory = row.get('subcategory')
+
+                    is_duplicate = bool(current_item_value) and current_item_value in duplicate_items
+                    label_key = (current_item_value, is_duplicate, i)
+                    label_cache = row.get('_label_cache')
+                    if label_cache and label_cache[:3] == label_key:
+                        expander_label = label_cache[3]
                     else:
-                        st.caption(f"Not recently ordered by {current_dept_for_filter}.")
-
-            with col2: 
-                st.text_input( "Note", value=current_note, key=note_key, placeholder="Optional note...", label_visibility="collapsed" )
+                        item_label = current_item_value if current_item_value else f"Item #{i+1}"
+                        duplicate_indicator = "⚠️ " if is_duplicate else ""
+                        expander_label = f"{duplicate_indicator}**{item_label}**"
+                        row['_label_cache'] = label_key + (expander_label,)
+
+                    # Row captions and the median lookup only change with the item, department or history maps
+                    caption_key = (current_item_value, current_dept, current_category, current_subcategory)
+                    caption_cache = row.get('_caption_cache')
+                    if not caption_cache or caption_cache[0] != caption_key or caption_cache[1] is not last_ordered_map:
+                        category_caption = f"Category: {current_category or '-'} | Sub-Cat: {current_subcategory or '-'}"
+                        last_ordered_caption, median_qty_val = None, None
+                        if current_item_value and current_dept:
+                            last_ordered_date_str = last_ordered_map.get((current_item_value, current_dept))
+                            if last_ordered_date_str:
+                                last_ordered_caption = f"Last ordered by {current_dept}: {last_ordered_date_str}"
+                            else:
+                                last_ordered_caption = f"Not recently ordered by {current_dept}."
+                            median_qty_val = median_qty_map.get((current_item_value, current_dept))
+                        caption_cache = (caption_key, last_ordered_map, category_caption, last_ordered_caption, median_qty_val)
+                        row['_caption_cache'] = caption_cache
+                    _, _, category_caption, last_ordered_caption, median_qty_val = caption_cache
+
+                    with st.container(border=True, key=f"row_{item_id}"): 
+                        st.markdown(expander_label)
+                        if is_duplicate: 
+                            st.warning(f"DUPLICATE ITEM: '{current_item_value}' is selected multiple times.", icon="⚠️")
+
+                        col1, col2, col3, col4 = st.columns([4, 3, 1, 1]) 
+                        with col1: 
+                            item_options, current_item_index = row_options, row_index_map.get(current_item_value, 0)
+                            if current_item_value and current_item_value not in row_index_map: 
+                                # Keep a row's chosen item selectable even when the filter doesn't match it
+                                item_options, current_item_index = ("", current_item_value) + row_options[1:], 1
+                            st.selectbox( 
+                                "Item Select", 
+                                options=item_options, 
+                                index=current_item_index, 
+                                key=selectbox_key, 
+                                placeholder="Select item...", 
+                                label_visibility="collapsed" 
+                            )
+                            st.caption(category_caption)
+                            if last_ordered_caption: 
+                                st.caption(last_ordered_caption)
+
+                        with col2: 
+                            st.text_input( "Note", value=current_note, key=note_key, placeholder="Optional note...", label_visibility="collapsed" )
             
-            with col3: 
-                st.number_input( 
-                    "Quantity", 
-                    min_value=0.001, 
-                    value=current_qty,  
-                    step=0.001,       
-                    format="%.3f",   
-                    key=qty_key, 
-                    label_visibility="collapsed" 
-                )
-                st.caption(f"Unit: {current_unit or '-'}") 
+                        with col3: 
+                            st.number_input( 
+                                "Quantity", 
+                                min_value=0.001, 
+                                value=current_qty,  
+                                step=0.001,       
+                                format="%.3f",   
+                                key=qty_key, 
+                                label_visibility="collapsed" 
+                            )
+                            st.caption(f"Unit: {current_unit or '-'}") 
             
-            with col4: 
-                if len(st.session_state.form_items) > 1: 
-                    st.button("❌", key=f"remove_{item_id}", on_click=remove_item, args=(item_id,), help="Remove this item")
-                else: st.write("") 
-
-            # Moved Unusual Order Quantity Alert outside the columns, but still in expander
-            current_dept_for_alert = st.session_state.get("selected_dept", "") 
-            if current_item_value and current_dept_for_alert:
-                median_qty_val = median_qty_map.get((current_item_value, current_dept_for_alert))
-                if median_qty_val is not None and median_qty_val > 0: 
-                    if current_qty > median_qty_val * 3 : 
-                        st.warning(f"Quantity {current_qty:.2f} for '{current_item_value}' is much higher than typical ({median_qty_val:.2f}).", icon="❗")
-                    elif current_qty < median_qty_val / 3 and current_qty > 0 : 
-                            st.info(f"Quantity {current_qty:.2f} for '{current_item_value}' is lower than typical ({median_qty_val:.2f}).", icon="ℹ️")
-
-
-    st.divider() 
-
-    col_add1, col_add2, col_add3 = st.columns([1, 2, 2])
-    with col_add1: 
-        st.number_input( "Add:", min_value=1, step=1, key='num_items_to_add', label_visibility="collapsed" )
-    with col_add2: 
-        st.button( "➕ Add Rows", on_click=handle_add_items_click, use_container_width=True )
-    with col_add3: 
-        st.button("🔄 Clear Item List", on_click=clear_all_items, use_container_width=True)
-
-    has_duplicates = bool(duplicates_found_dict)
-    has_valid_items = any(item.get('item') and float(item.get('qty', 0.0)) > 0 for item in st.session_state.form_items) 
-    current_dept_tab1_val = st.session_state.get("selected_dept", "") 
-    requester_name_filled = bool(st.session_state.get("requested_by", "").strip())
-    submit_disabled = not has_valid_items or has_duplicates or not current_dept_tab1_val or not requester_name_filled
-    error_messages = []
-    tooltip_message = "Submit the current indent request."
-    
-    if not has_valid_items: error_messages.append("Add at least one valid item with quantity > 0.")
-    if has_duplicates: error_messages.append(f"Remove duplicate items (marked with ⚠️): {', '.join(duplicates_found_dict.keys())}.")
-    if not current_dept_tab1_val: error_messages.append("Select a department (marked with *).") 
-    if not requester_name_filled: error_messages.append("Enter the requester's name (marked with *).") 
-    st.divider()
-    if error_messages:
-        for msg in error_messages: st.warning(f"⚠️ {msg}")
-        tooltip_message = "Please fix the issues listed above."
-
-
-    if st.button("Submit Indent Request", type="primary", use_container_width=True, disabled=submit_disabled, help=tooltip_message):
-        final_items_to_submit_unsorted: List[Tuple[str, float, str, str, Optional[str], Optional[str]]] = [] 
-        
-        final_check_items = [item['item'] for item in st.session_state.form_items if item.get('item') and float(item.get('qty',0.0)) > 0]
-        final_check_counts = Counter(final_check_items)
-        final_duplicates_dict = {item: count for item, count in final_check_counts.items() if count > 1}
-        if bool(final_duplicates_dict): 
-            st.error(f"Duplicate items detected ({', '.join(final_duplicates_dict.keys())}). Please consolidate."); st.stop()
-        
-        for item_dict in st.session_state.form_items:
-            selected_item = item_dict.get('item')
-            qty = float(item_dict.get('qty', 0.0)) 
-            unit = item_dict.get('unit', '-')
-            note = item_dict.get('note', '')
-            category = item_dict.get('category')
-            subcategory = item_dict.get('subcategory')
-            if selected_item and qty > 0 and unit != '-': 
-                final_items_to_submit_unsorted.append(( selected_item, qty, unit, note, category or "Uncategorized", subcategory or "General" ))
-            elif selected_item and qty > 0 and unit == '-':
-                st.warning(f"Item '{selected_item}' has quantity but no unit. It will be skipped.")
-
-        if not final_items_to_submit_unsorted: 
-            st.error("No valid items to submit."); st.stop()
+                        with col4: 
+                            if show_remove_buttons: 
+                                st.form_submit_button("❌", key=f"remove_{item_id}", on_click=remove_item, args=(item_id,), help="Remove this item")
+                            else: st.write("") 
+
+                        # Unusual Order Quantity Alert sits below the columns, inside the row container
+                        if median_qty_val is not None and median_qty_val > 0: 
+                            if current_qty > median_qty_val * 3 : 
+                                st.warning(f"Quantity {current_qty:.2f} for '{current_item_value}' is much higher than typical ({median_qty_val:.2f}).", icon="❗")
+                            elif current_qty < median_qty_val / 3 and current_qty > 0 : 
+                                    st.info(f"Quantity {current_qty:.2f} for '{current_item_value}' is lower than typical ({median_qty_val:.2f}).", icon="ℹ️")
+
+
+            st.divider() 
+
+            col_add1, col_add2, col_add3, col_add4 = st.columns([1, 2, 2, 2])
+            with col_add1: 
+                st.number_input( "Add:", min_value=1, step=1, key='num_items_to_add', label_visibility="collapsed" )
+            with col_add2: 
+                st.form_submit_button( "➕ Add Rows", on_click=handle_add_items_click, use_container_width=True )
+            with col_add3: 
+                st.form_submit_button( "✅ Apply Changes", on_click=apply_item_edits, use_container_width=True )
+            with col_add4: 
+                st.form_submit_button("🔄 Clear Item List", on_click=clear_all_items, use_container_width=True)
+            st.caption("Item, quantity and note edits are applied together when you click Apply Changes, add/remove rows, or submit.")
+
+            current_dept_tab1_val = current_dept
+            requester_name_filled = bool(requester_value)
+            # Only the fields outside the form can block the button; item rows are checked once the click has applied them
+            submit_disabled = not current_dept_tab1_val or not requester_name_filled
+            tooltip_message = "Submit the current indent request."
+            st.divider()
+            # Messages are only assembled when something actually blocks submission
+            if submit_disabled:
+                error_messages = []
+                if not current_dept_tab1_val: error_messages.append("Select a department (marked with *).") 
+                if not requester_name_filled: error_messages.append("Enter the requester's name (marked with *).") 
+                for msg in error_messages: st.warning(f"⚠️ {msg}")
+                tooltip_message = "Please fix the issues listed above."
+
+
+            if st.form_submit_button("Submit Indent Request", type="primary", use_container_width=True, disabled=submit_disabled, help=tooltip_message, on_click=apply_item_edits):
+                # apply_item_edits ran as this click's callback, so the derived values include the edits just submitted
+                has_valid_items, duplicate_items, ready_items, unitless_items, _ = get_form_derived()
+                if not has_valid_items: 
+                    st.error("Add at least one valid item with quantity > 0."); st.stop()
+                if duplicate_items: 
+                    st.error(f"Remove duplicate items (marked with ⚠️): {', '.join(sorted(duplicate_items))}."); st.stop()
         
-        final_items_to_submit = sorted( final_items_to_submit_unsorted, key=lambda x: (str(x[4] or ''), str(x[5] or ''), str(x[0])) )
-        requester = st.session_state.get("requested_by", "").strip()
-        current_dept_submit_val = st.session_state.get("selected_dept", "") 
+                for selected_item in unitless_items:
+                    st.warning(f"Item '{selected_item}' has quantity but no unit. It will be skipped.")
 
-        try:
-            mrn = generate_mrn()
-            if "ERR" in mrn: 
-                st.error(f"Failed MRN ({mrn})."); st.stop()
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            date_to_format = st.session_state.get("selected_date", date.today())
-            formatted_date = date_to_format.strftime("%d-%m-%Y")
+                if not ready_items: 
+                    st.error("No valid items to submit."); st.stop()
+        
+                final_items_to_submit = sorted( ready_items, key=itemgetter(4, 5, 0) )
+                requester = requester_value
+                current_dept_submit_val = current_dept
+
+                try:
+                    mrn = generate_mrn()
+                    if "ERR" in mrn: 
+                        st.error(f"Failed MRN ({mrn})."); st.stop()
+                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    date_to_format = delivery_date
+                    formatted_date = date_to_format.strftime("%d-%m-%Y")
             
-            rows_to_add = [[mrn, timestamp, requester, current_dept_submit_val, formatted_date, 
-                            item, f"{qty_val:.3f}", unit, note if note else "N/A"] 
-                           for item, qty_val, unit, note, cat, subcat in final_items_to_submit]
+                    # Generator: rows are built chunk by chunk as append_log_rows consumes them
+                    rows_to_add = ([mrn, timestamp, requester, current_dept_submit_val, formatted_date, 
+                                    item, round(qty_val, 3), unit, note if note else "N/A"] 
+                                   for item, qty_val, unit, note, cat, subcat in final_items_to_submit)
             
-            if rows_to_add and log_sheet:
-                with st.spinner(f"Submitting indent {mrn}..."):
-                    try: 
-                        log_sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
-                        load_indent_log_data.clear()
-                        calculate_top_items_per_dept_smarter.clear() 
-                        get_last_ordered_dates_map.clear() 
-                        get_median_order_quantities_map.clear()
-                    except gspread.exceptions.APIError as e: 
-                        st.error(f"API Error: {e}."); st.stop()
-                    except Exception as e: 
-                        st.error(f"Submission error: {e}"); st.exception(e); st.stop()
-                st.session_state['submitted_data_for_summary'] = {'mrn': mrn, 'dept': current_dept_submit_val, 'date': formatted_date, 'requester': requester, 'items': final_items_to_submit}
-                st.session_state['last_dept'] = current_dept_submit_val
-                clear_all_items()
-                st.rerun()
-        except Exception as e: 
-            st.error(f"Submission error: {e}"); st.exception(e)
-
-
-    if st.session_state.get('submitted_data_for_summary'):
-        submitted_data = st.session_state['submitted_data_for_summary']
-        st.success(f"Indent submitted! MRN: {submitted_data['mrn']}")
-        st.balloons(); st.divider(); st.subheader("Submitted Indent Summary")
-        st.info(f"**MRN:** {submitted_data['mrn']} | **Dept:** {submitted_data['dept']} | **Reqd Date:** {submitted_data['date']} | **By:** {submitted_data.get('requester', 'N/A')}")
+                    if log_sheet:
+                        with st.spinner(f"Submitting indent {mrn} ({len(final_items_to_submit)} items)..."):
+                            try: 
+                                append_log_rows(rows_to_add)
+                                st.session_state['_log_last_row'] = st.session_state.get('_log_last_row', 0) + len(final_items_to_submit)
+                                st.session_state['_next_mrn'] = int(mrn[4:]) + 1
+                            except gspread.exceptions.APIError as e: 
+                                st.session_state.pop('_next_mrn', None)
+                                st.error(f"API Error: {e}."); st.stop()
+                            except Exception as e: 
+                                st.error(f"Submission error: {e}"); st.exception(e); st.stop()
+                        # The rows are in the sheet now: a failure updating this session's copies must not read as a failed submit
+                        try: 
+                            bump_top_items(current_dept_submit_val, [row[0] for row in final_items_to_submit])
+                            st.session_state.log_df = merge_submitted_into_log(log_data_for_analysis, mrn, timestamp, requester, 
+                                                                               current_dept_submit_val, delivery_date, final_items_to_submit)
+                        except Exception as e: 
+                            refresh_log()
+                            st.session_state.pop('top_items_map', None)
+                            st.session_state.pop('dept_item_counts', None)
+                            st.session_state['_submit_warning'] = f"Indent {mrn} was submitted, but the local history could not be updated ({e}). It will be reloaded from the sheet."
+                        st.session_state['submitted_data_for_summary'] = {'mrn': mrn, 'dept': current_dept_submit_val, 'date': formatted_date, 'requester': requester, 'items': final_items_to_submit}
+                        st.session_state['last_dept'] = current_dept_submit_val
+                        clear_all_items()
+                        st.rerun()
+                except Exception as e: 
+                    st.error(f"Submission error: {e}"); st.exception(e)
+
+    render_item_editor(current_dept, requester_value, delivery_date)
+
+
+    @st.fragment
+    def render_submission_summary():
+        """Summary of the last submitted indent with its PDF and WhatsApp actions, rerun on its own."""
+        if st.session_state.get('submitted_data_for_summary'):
+            submitted_data = st.session_state['submitted_data_for_summary']
+            st.success(f"Indent submitted! MRN: {submitted_data['mrn']}")
+            if st.session_state.get('_submit_warning'): 
+                st.warning(st.session_state.pop('_submit_warning'))
+            st.balloons(); st.divider(); st.subheader("Submitted Indent Summary")
+            st.info(f"**MRN:** {submitted_data['mrn']} | **Dept:** {submitted_data['dept']} | **Reqd Date:** {submitted_data['date']} | **By:** {submitted_data.get('requester', 'N/A')}")
         
-        submitted_df_data = [list(item_s) for item_s in submitted_data['items']]
-        submitted_df = pd.DataFrame( submitted_df_data, columns=["Item", "Qty", "Unit", "Note", "Category", "Sub-Category"] )
+            submitted_df_data = [list(item_s) for item_s in submitted_data['items']]
+            submitted_df = pd.DataFrame( submitted_df_data, columns=["Item", "Qty", "Unit", "Note", "Category", "Sub-Category"] )
         
-        st.dataframe(submitted_df, hide_index=True, use_container_width=True, 
-                     column_config={ 
-                         "Category": st.column_config.TextColumn("Category"), 
-                         "Sub-Category": st.column_config.TextColumn("Sub-Cat"),
-                         "Qty": st.column_config.NumberColumn("Qty", format="%.3f") 
-                     })
-        total_submitted_qty = sum(float(item[1]) for item in submitted_data['items']) 
-        st.markdown(f"**Total Submitted Items (sum of quantities):** {total_submitted_qty:.3f}"); st.divider() 
+            st.dataframe(submitted_df, hide_index=True, use_container_width=True, column_config=SUMMARY_COLUMN_CONFIG)
+            total_submitted_qty = float(submitted_df['Qty'].to_numpy(dtype=float).sum())
+            st.markdown(f"**Total Submitted Items (sum of quantities):** {total_submitted_qty:.3f}"); st.divider() 
         
-        col_btn1, col_btn2 = st.columns(2)
-        with col_btn1:
-            try: 
-                pdf_data_bytes = create_indent_pdf(submitted_data) 
-                st.download_button(label="📄 Download PDF", data=pdf_data_bytes, 
-                                   file_name=f"Indent_{submitted_data['mrn']}.pdf", mime="application/pdf", use_container_width=True)
-            except Exception as pdf_error: 
-                st.error(f"Could not generate PDF: {pdf_error}"); st.exception(pdf_error)
-        with col_btn2:
-            try:
-                wa_text = (f"Indent Submitted:\nMRN: {submitted_data.get('mrn', 'N/A')}\n"
-                           f"Department: {submitted_data.get('dept', 'N/A')}\n"
-                           f"Requested By: {submitted_data.get('requester', 'N/A')}\n"
-                           f"Date Required: {submitted_data.get('date', 'N/A')}\n\n"
-                           "Please see attached PDF for item details.")
-                encoded_text = urllib.parse.quote_plus(wa_text)
-                wa_url = f"https://wa.me/?text={encoded_text}"
-                st.link_button("✅ Prepare WhatsApp Message", wa_url, use_container_width=True) 
-            except Exception as wa_e: 
-                st.error(f"Could not create WhatsApp link: {wa_e}")
+            col_btn1, col_btn2 = st.columns(2)
+            with col_btn1:
+                try: 
+                    pdf_data_bytes = get_indent_pdf(submitted_data['mrn'], submitted_data)
+                    st.download_button(label="📄 Download PDF", data=pdf_data_bytes, 
+                                       file_name=f"Indent_{submitted_data['mrn']}.pdf", mime="application/pdf", use_container_width=True, on_click="ignore")
+                except Exception as pdf_error: 
+                    st.error(f"Could not generate PDF: {pdf_error}"); st.exception(pdf_error)
+            with col_btn2:
+                try:
+                    wa_url = get_whatsapp_url(submitted_data.get('mrn', 'N/A'), submitted_data.get('dept', 'N/A'),
+                                              submitted_data.get('requester', 'N/A'), submitted_data.get('date', 'N/A'))
+                    st.link_button("✅ Prepare WhatsApp Message", wa_url, use_container_width=True) 
+                except Exception as wa_e: 
+                    st.error(f"Could not create WhatsApp link: {wa_e}")
         
-        st.caption("Your name in 'Requested By' will be remembered for the next indent.") 
-        st.divider() 
+            st.caption("Your name in 'Requested By' will be remembered for the next indent.") 
+            st.divider() 
         
-        if st.button("Start New Indent"): 
-            st.session_state['submitted_data_for_summary'] = None
-            st.rerun() 
+            if st.button("Start New Indent"): 
+                st.session_state['submitted_data_for_summary'] = None
+                st.rerun() 
+
+    render_submission_summary()
 
 # --- TAB 2: View Indents ---
 with tab2:
     st.subheader("View Past Indent Requests")
-    log_df_tab2 = load_indent_log_data() 
+    st.button("🔄 Refresh Log", key="refresh_log", on_click=refresh_log, help="Re-fetch the indent log from Google Sheets (picks up indents submitted by others).")
+    log_df_tab2 = st.session_state.log_df 
     if not log_df_tab2.empty:
         st.divider()
         with st.expander("Filter Options", expanded=True):
-            dept_options = sorted([d for d in log_df_tab2['Department'].unique() if d and d != ''])
-            requester_options = sorted([r for r in log_df_tab2['Requested By'].unique() if r and r != '']) if 'Requested By' in log_df_tab2.columns else []
-            
-            min_ts = log_df_tab2['Date Required'].dropna().min()
-            max_ts = log_df_tab2['Date Required'].dropna().max()
+            dept_options, requester_options, min_ts, max_ts = log_filter_options(log_df_tab2)
             default_start = date.today() - pd.Timedelta(days=90)
             
             min_date_log = min_ts.date() if pd.notna(min_ts) else default_start
@@ -775,61 +1160,71 @@ with tab2:
             calculated_default_start = max(min_date_log, default_start) if default_start < max_date_log else min_date_log
             if calculated_default_start > max_date_log : calculated_default_start = min_date_log
             
-            filt_col1, filt_col2, filt_col3 = st.columns([1, 1, 2])
-            with filt_col1:
-                filt_start_date = st.date_input("Reqd. From", value=calculated_default_start, 
-                                             min_value=min_date_log, max_value=max_date_log, 
-                                             key="filt_start", format="DD/MM/YYYY")
-                valid_end_min = filt_start_date
-                filt_end_date = st.date_input("Reqd. To", value=max_date_log, 
-                                           min_value=valid_end_min, max_value=max_date_log, 
-                                           key="filt_end", format="DD/MM/YYYY")
-            with filt_col2:
-                selected_depts = st.multiselect("Department", options=dept_options, default=[], key="filt_dept")
-                if requester_options: 
-                    selected_requesters = st.multiselect("Requested By", options=requester_options, default=[], key="filt_req")
-            with filt_col3: 
-                mrn_search = st.text_input("MRN", key="filt_mrn", placeholder="e.g., MRN-005")
-                item_search = st.text_input("Item Name", key="filt_item", placeholder="e.g., Salt")
+            # Filters live in a form so typing an MRN or item name doesn't rerun the page on every keystroke
+            with st.form("log_filters", border=False):
+                filt_col1, filt_col2, filt_col3 = st.columns([1, 1, 2])
+                with filt_col1:
+                    filt_start_date = st.date_input("Reqd. From", value=calculated_default_start, 
+                                                 min_value=min_date_log, max_value=max_date_log, 
+                                                 key="filt_start", format="DD/MM/YYYY")
+                    filt_end_date = st.date_input("Reqd. To", value=max_date_log, 
+                                               min_value=min_date_log, max_value=max_date_log, 
+                                               key="filt_end", format="DD/MM/YYYY")
+                selected_requesters: List[str] = []
+                with filt_col2:
+                    selected_depts = st.multiselect("Department", options=dept_options, default=[], key="filt_dept")
+                    if requester_options: 
+                        selected_requesters = st.multiselect("Requested By", options=requester_options, default=[], key="filt_req")
+                with filt_col3: 
+                    mrn_search = st.text_input("MRN", key="filt_mrn", placeholder="e.g., MRN-005")
+                    item_search = st.text_input("Item Name", key="filt_item", placeholder="e.g., Salt")
+                st.form_submit_button("🔍 Apply Filters")
         st.caption("Showing indents required in the last 90 days by default. Use filters above to view older records.")
         
-        filtered_df = log_df_tab2.copy()
-        try: 
-            start_filter_ts = pd.Timestamp(st.session_state.filt_start)
-            end_filter_ts = pd.Timestamp(st.session_state.filt_end)
-            date_filt_cond = (filtered_df['Date Required'].notna() & 
-                              (filtered_df['Date Required'].dt.normalize() >= start_filter_ts) & 
-                              (filtered_df['Date Required'].dt.normalize() <= end_filter_ts))
-            filtered_df = filtered_df[date_filt_cond]
-            if st.session_state.filt_dept: 
-                filtered_df = filtered_df[filtered_df['Department'].isin(st.session_state.filt_dept)]
-            if requester_options and 'filt_req' in st.session_state and st.session_state.filt_req: 
-                if 'Requested By' in filtered_df.columns: 
-                    filtered_df = filtered_df[filtered_df['Requested By'].isin(st.session_state.filt_req)]
-            if st.session_state.filt_mrn: 
-                filtered_df = filtered_df[filtered_df['MRN'].astype(str).str.contains(st.session_state.filt_mrn, case=False, na=False)]
-            if st.session_state.filt_item: 
-                filtered_df = filtered_df[filtered_df['Item'].astype(str).str.contains(st.session_state.filt_item, case=False, na=False)]
-        except Exception as filter_e: 
-            st.error(f"Filter error: {filter_e}")
+        filtered_df = log_df_tab2
+        mrn_needle = mrn_search.strip().lower()
+        item_needle = item_search.strip().lower()
+        # Reruns from Tab 1 or the pager leave the applied filters unchanged, so reuse the last result for this log frame
+        filter_key = (filt_start_date, filt_end_date, tuple(selected_depts), tuple(selected_requesters), mrn_needle, item_needle)
+        tab2_cache = st.session_state.get('_tab2_cache')
+        if tab2_cache and tab2_cache[0] is log_df_tab2 and tab2_cache[1] == filter_key: 
+            filtered_df = tab2_cache[2]
+        else: 
+            try: 
+                # Collect every active condition as a NumPy mask, reduce them in one pass and slice the log once
+                masks = [date_range_mask(log_df_tab2, filt_start_date, filt_end_date)]
+                if selected_depts: 
+                    masks.append(log_df_tab2['Department'].isin(selected_depts).to_numpy())
+                if selected_requesters: 
+                    masks.append(log_df_tab2['Requested By'].isin(selected_requesters).to_numpy())
+                if mrn_needle: 
+                    masks.append(substring_mask(log_df_tab2['_mrn_lc'], mrn_needle))
+                if item_needle: 
+                    masks.append(substring_mask(log_df_tab2['_item_lc'], item_needle))
+                combined_mask = np.logical_and.reduce(masks)
+                # Nothing filtered out: show the log frame itself rather than a full boolean-indexed copy
+                if not combined_mask.all(): 
+                    filtered_df = log_df_tab2[combined_mask]
+                st.session_state['_tab2_cache'] = (log_df_tab2, filter_key, filtered_df)
+            except Exception as filter_e: 
+                st.error(f"Filter error: {filter_e}")
         
         st.divider()
         st.write(f"Displaying {len(filtered_df)} records based on filters:")
+        # Only one page of rows is serialized and sent to the browser per rerun
+        page_df = filtered_df
+        n_pages = max(1, -(-len(filtered_df) // LOG_PAGE_SIZE))
+        if n_pages > 1: 
+            if st.session_state.get('log_page', 1) > n_pages: 
+                st.session_state['log_page'] = 1
+            page = st.number_input(f"Page (of {n_pages}, {LOG_PAGE_SIZE} rows each)", min_value=1, max_value=n_pages, step=1, key="log_page")
+            page_df = filtered_df.iloc[(page - 1) * LOG_PAGE_SIZE:page * LOG_PAGE_SIZE]
         st.dataframe( 
-            filtered_df, 
+            page_df, 
             use_container_width=True, 
             hide_index=True,
-            column_config={ 
-                "Date Required": st.column_config.DateColumn("Date Reqd.", format="DD/MM/YYYY"), 
-                "Timestamp": st.column_config.DatetimeColumn("Submitted", format="YYYY-MM-DD HH:mm"), 
-                "Requested By": st.column_config.TextColumn("Req. By"), 
-                "Qty": st.column_config.NumberColumn("Qty", format="%.3f"), 
-                "MRN": st.column_config.TextColumn("MRN"), 
-                "Department": st.column_config.TextColumn("Dept."), 
-                "Item": st.column_config.TextColumn("Item Name", width="medium"), 
-                "Unit": st.column_config.TextColumn("Unit"), 
-                "Note": st.column_config.TextColumn("Notes", width="large"), 
-            } 
+            column_order=LOG_COLUMNS,
+            column_config=LOG_COLUMN_CONFIG
         )
     else: 
         st.info("No indent records found or log is unavailable.")